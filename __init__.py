@@ -7,5 +7,6 @@ The following types of functionality are found here:
 - sorting.py: Common types of sorting.
 - decorators.py: Function decorators I often use.
 - db.py: Functions for programatically manipulating databases.
+- npexport.py: Exporting database columns to NumPy arrays and memory-mapped .npy files.
 - swn.py: Interface to SentiWordNet.
 """
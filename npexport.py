@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+#! utils/npexport.py
+
+"""This module exports database columns to NumPy arrays and memory-mapped .npy files.
+
+Columns are streamed out of MySQL in chunks into preallocated arrays typed from the table schema,
+so the values never exist as one big list of Python objects. Exported .npy files can be re-opened
+later without touching the database.
+
+Nullable columns whose dtype has no missing value of its own (integers, strings, binary) come back
+as masked arrays. Floats use NaN for NULL and dates use NaT. DECIMAL columns of up to 15 digits are
+read as float64; wider ones map to object and need an explicit dtype to be exported.
+"""
+
+import MySQLdb as mdb
+import numpy as np
+import os, os.path
+import re
+from utils import db
+
+# Byte widths of the MySQL integer types.
+INT_TYPES = {'tinyint': 1, 'smallint': 2, 'mediumint': 4, 'int': 4, 'integer': 4, 'bigint': 8,
+             'year': 2}
+FLOAT_TYPES = {'float': 'f4', 'double': 'f8', 'real': 'f8'}
+DECIMAL_TYPES = ('decimal', 'numeric')
+STRING_TYPES = ('char', 'varchar', 'enum')
+BINARY_TYPES = ('binary', 'varbinary')
+DATE_TYPES = ('date', 'datetime', 'timestamp')
+
+# Widest DECIMAL that float64 holds exactly.
+MAX_FLOAT_DIGITS = 15
+
+# Widest encoding of a character in any MySQL charset (utf8mb4, utf16, utf32).
+MAX_BYTES_PER_CHAR = 4
+
+# Dtype kinds that cannot represent NULL themselves, and so need a separate mask.
+MASKED_KINDS = 'iuSV'
+
+def get_column_info(conn, table_name):
+    """Returns a dict mapping each column in a table to a (type_description, nullable,
+    char_length) triple. The char length is the maximum length in characters of a character
+    column, and None for other columns.
+
+    Column names are lower-cased, since MySQL compares them case-insensitively.
+    """
+    query = ("SELECT COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, CHARACTER_MAXIMUM_LENGTH "
+             "FROM information_schema.COLUMNS "
+             "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '%s'" % table_name)
+    rows = db.get_rows(db.run_query(conn, query))
+    return dict((row[0].lower(), (row[1], row[2] == 'YES', row[3])) for row in rows)
+
+def numpy_dtype(type_desc, char_length=None):
+    """Returns the NumPy dtype for a MySQL type description such as 'int(11) unsigned' or
+    'varchar(20)'.
+
+    Character columns hold char_length (or the declared length) characters of up to
+    MAX_BYTES_PER_CHAR bytes each, so any encoding of them fits. BINARY and VARBINARY map to raw
+    void dtypes, which keep trailing zero bytes. DATETIME and TIMESTAMP keep their fractional
+    seconds. DECIMAL maps to float64 if it has at most MAX_FLOAT_DIGITS digits. Types without a
+    fixed-width equivalent (TEXT, BLOB, wide DECIMAL, ...) map to object.
+    """
+    match = re.match(r'(\w+)(?:\((.*)\))?\s*(.*)', type_desc.strip().lower())
+    base, args, modifiers = match.groups()
+    if base in INT_TYPES:
+        kind = 'u' if 'unsigned' in modifiers else 'i'
+        return np.dtype('%s%d' % (kind, INT_TYPES[base]))
+    if base in FLOAT_TYPES:
+        return np.dtype(FLOAT_TYPES[base])
+    if base in DECIMAL_TYPES:
+        precision = int(args.split(',')[0]) if args else 10
+        return np.dtype('f8' if precision <= MAX_FLOAT_DIGITS else object)
+    if base in STRING_TYPES:
+        if not char_length:
+            if base == 'enum':
+                char_length = max(len(option) for option in re.findall(r"'((?:[^']|'')*)'", args))
+            else:
+                char_length = int(args or 1)
+        return np.dtype('S%d' % (char_length * MAX_BYTES_PER_CHAR))
+    if base in BINARY_TYPES:
+        return np.dtype('V%d' % int(args or 1))
+    if base == 'date':
+        return np.dtype('M8[D]')
+    if base in DATE_TYPES:
+        fsp = int(args or 0)
+        if fsp == 0:
+            return np.dtype('M8[s]')
+        return np.dtype('M8[ms]' if fsp <= 3 else 'M8[us]')
+    return np.dtype(object)
+
+def column_specs(conn, table_name, column_names, dtypes=None):
+    """Returns a list of (dtype, masked) pairs for the given columns, based on the table schema.
+
+    Entries in the optional dtypes dict override the schema mapping for those columns. masked is
+    True for nullable columns whose dtype cannot hold NULL. Column names are matched as MySQL
+    does, ignoring case and backquotes.
+    """
+    if not column_names:
+        raise ValueError("No columns given for table %s" % table_name)
+    info = get_column_info(conn, table_name)
+    ret = []
+    for name in column_names:
+        key = name.strip('`').lower()
+        if not info.has_key(key):
+            raise ValueError("No column %s in table %s" % (name, table_name))
+        type_desc, nullable, char_length = info[key]
+        if dtypes and dtypes.has_key(name):
+            dtype = np.dtype(dtypes[name])
+        else:
+            dtype = numpy_dtype(type_desc, char_length)
+        ret.append((dtype, nullable and dtype.kind in MASKED_KINDS))
+    return ret
+
+def count_rows(conn, table_name, limit=None):
+    "Returns the number of rows in the given table, counting no further than limit."
+    if limit is None:
+        return db.count_table_rows(conn, table_name)
+    query = "SELECT COUNT(*) FROM (SELECT 1 FROM %s LIMIT %d) AS limited" % (table_name, limit)
+    return db.get_rows(db.run_query(conn, query))[0][0]
+
+def convert_values(values, arr, column_name):
+    """Prepares a chunk of column values for assignment into arr.
+
+    Unicode strings are encoded as UTF-8. Raises ValueError if a string or binary value is wider
+    than the array's itemsize, rather than letting NumPy truncate it.
+    """
+    if arr.dtype.kind not in 'SV':
+        return values
+    values = [value.encode('utf-8') if isinstance(value, unicode) else value for value in values]
+    widest = max(len(value) for value in values)
+    if widest > arr.dtype.itemsize:
+        raise ValueError("Column %s has a value of %d bytes, which does not fit in dtype %s"
+                         % (column_name, widest, arr.dtype))
+    return values
+
+def fill_columns(conn, table_name, column_names, arrays, masks, chunk_size=10000):
+    """Streams the given columns of a table into preallocated arrays, one chunk of rows at a time.
+
+    The arrays may be ordinary arrays or memory maps; only chunk_size rows are held in Python at
+    once. masks holds a boolean array for each masked column and None for the others; NULLs in a
+    masked column are flagged there and stored as zero in the data array. Reading stops when the
+    arrays are full. Returns the number of rows written.
+    """
+    length = len(arrays[0])
+    query = "SELECT %s FROM %s LIMIT %d" % (', '.join(column_names), table_name, length)
+    cursor = conn.cursor(mdb.cursors.SSCursor)
+    try:
+        cursor.execute(query)
+        pos = 0
+        while pos < length:
+            rows = cursor.fetchmany(min(chunk_size, length - pos))
+            if not rows:
+                break
+            end = pos + len(rows)
+            for index, (name, arr, mask) in enumerate(zip(column_names, arrays, masks)):
+                values = [row[index] for row in rows]
+                if mask is not None:
+                    nulls = [value is None for value in values]
+                    mask[pos:end] = nulls
+                    fill = '' if arr.dtype.kind in 'SV' else 0
+                    values = [fill if null else value for null, value in zip(nulls, values)]
+                arr[pos:end] = convert_values(values, arr, name)
+            pos = end
+        return pos
+    finally:
+        cursor.close()
+
+def get_columns_as_arrays(conn, table_name, column_names, limit=None, dtypes=None,
+                          chunk_size=10000):
+    """Returns a dict mapping column names to NumPy arrays holding the contents of those columns.
+
+    Types are taken from the table schema (see numpy_dtype) unless overridden in dtypes. Masked
+    columns are returned as numpy.ma masked arrays.
+    """
+    try:
+        specs = column_specs(conn, table_name, column_names, dtypes)
+        length = count_rows(conn, table_name, limit)
+        arrays = [np.empty(length, dtype=dtype) for dtype, masked in specs]
+        masks = [np.zeros(length, dtype=bool) if masked else None for dtype, masked in specs]
+        rows = fill_columns(conn, table_name, column_names, arrays, masks, chunk_size)
+        ret = {}
+        for name, arr, mask in zip(column_names, arrays, masks):
+            if mask is None:
+                ret[name] = arr[:rows]
+            else:
+                ret[name] = np.ma.MaskedArray(arr[:rows], mask=mask[:rows])
+        return ret
+
+    except mdb.Error, e:
+        db.DB_ERROR(e, "DATABASE READ FAILED")
+
+def npy_path(out_dir, column_name):
+    "Returns the path of the .npy file that a column is exported to."
+    return os.path.join(out_dir, column_name + '.npy')
+
+def mask_path(out_dir, column_name):
+    "Returns the path of the .npy file holding a column's NULL mask."
+    return os.path.join(out_dir, column_name + '.mask.npy')
+
+def truncate_npy(path, length):
+    "Rewrites a .npy file to keep only its first length entries, without loading it into memory."
+    old = np.load(path, mmap_mode='r')
+    tmp_path = path + '.trunc'
+    new = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=old.dtype, shape=(length,))
+    new[:] = old[:length]
+    new.flush()
+    del new, old
+    os.rename(tmp_path, path)
+
+def export_columns_to_npy(conn, table_name, column_names, out_dir, limit=None, dtypes=None,
+                          chunk_size=10000):
+    """Exports columns of a table to memory-mapped .npy files in out_dir, one file per column.
+
+    Rows are written to disk in chunks, so tables larger than memory can be exported. Columns must
+    map to fixed-width dtypes; masked columns also get a .mask.npy file. Files are written under
+    temporary names and only moved into place once every column is complete, so a failed export
+    leaves nothing behind. Returns a dict mapping column names to the paths written; the files can
+    be re-opened later with load_npy_columns.
+    """
+    try:
+        specs = column_specs(conn, table_name, column_names, dtypes)
+        for name, (dtype, masked) in zip(column_names, specs):
+            if dtype.hasobject:
+                raise ValueError("Column %s has no fixed-width dtype; pass one in dtypes" % name)
+        length = count_rows(conn, table_name, limit)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        # (final path, dtype) for every file to write, and the index of each column's mask in it.
+        targets = []
+        mask_indices = []
+        for name, (dtype, masked) in zip(column_names, specs):
+            targets.append((npy_path(out_dir, name), dtype))
+        for name, (dtype, masked) in zip(column_names, specs):
+            if masked:
+                mask_indices.append(len(targets))
+                targets.append((mask_path(out_dir, name), np.dtype(bool)))
+            else:
+                mask_indices.append(None)
+        tmp_paths = [path + '.tmp' for path, dtype in targets]
+
+        done = False
+        try:
+            memmaps = [np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(length,))
+                     for tmp_path, (path, dtype) in zip(tmp_paths, targets)]
+            masks = [None if index is None else memmaps[index] for index in mask_indices]
+            rows = fill_columns(conn, table_name, column_names, memmaps[:len(column_names)], masks,
+                                chunk_size)
+            for arr in memmaps:
+                arr.flush()
+            del memmaps, masks
+            if rows < length:
+                # The table shrank between counting and reading.
+                for tmp_path in tmp_paths:
+                    truncate_npy(tmp_path, rows)
+            for tmp_path, (path, dtype) in zip(tmp_paths, targets):
+                os.rename(tmp_path, path)
+            done = True
+        finally:
+            if not done:
+                for tmp_path in tmp_paths:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+        # Drop masks left over from an earlier export of a column that is no longer masked.
+        for name, index in zip(column_names, mask_indices):
+            if index is None and os.path.exists(mask_path(out_dir, name)):
+                os.remove(mask_path(out_dir, name))
+        return dict((name, npy_path(out_dir, name)) for name in column_names)
+
+    except mdb.Error, e:
+        db.DB_ERROR(e, "DATABASE EXPORT FAILED")
+
+def load_npy_columns(out_dir, column_names, mmap_mode='r'):
+    """Re-opens columns exported by export_columns_to_npy as memory-mapped arrays. Columns with a
+    mask file are returned as numpy.ma masked arrays over the memory maps.
+    """
+    ret = {}
+    for name in column_names:
+        arr = np.load(npy_path(out_dir, name), mmap_mode=mmap_mode)
+        if os.path.exists(mask_path(out_dir, name)):
+            mask = np.load(mask_path(out_dir, name), mmap_mode=mmap_mode)
+            arr = np.ma.MaskedArray(arr, mask=mask, copy=False)
+        ret[name] = arr
+    return ret
+
+
+def test_dtypes():
+    print numpy_dtype('int(11)')
+    print numpy_dtype('int(10) unsigned')
+    print numpy_dtype('bigint(20) unsigned')
+    print numpy_dtype('year(4)')
+    print numpy_dtype('varchar(20)')
+    print numpy_dtype('varchar(20)', char_length=10)
+    print numpy_dtype("enum('a','bcd')")
+    print numpy_dtype('binary(16)')
+    print numpy_dtype('decimal(10,2)')
+    print numpy_dtype('decimal(30,2)')
+    print numpy_dtype('datetime')
+    print numpy_dtype('datetime(3)')
+    print numpy_dtype('timestamp(6)')
+    print numpy_dtype('text')
+
+def test_arrays(conn):
+    print get_columns_as_arrays(conn, 'Writers', ['Id', 'Name'])
+    print get_columns_as_arrays(conn, 'Writers', ['id'], limit=2, chunk_size=1)
+    print export_columns_to_npy(conn, 'Writers', ['Id', 'Name'], '/tmp/writers')
+    print load_npy_columns('/tmp/writers', ['Id', 'Name'])
+
+def test():
+    conn = mdb.connect('localhost', 'test', 'testpass', 'testdb')
+    test_dtypes()
+    test_arrays(conn)
+
+if __name__ == '__main__':
+    test()